@@ -3,21 +3,42 @@ Excalidraw JSON builder: Converts structured flowchart data
 (nodes + arrows) into a valid .excalidraw JSON file.
 """
 
-import json
+import base64
+import logging
 import math
-import random
-import string
+import os
 import time
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import orjson
+
+log = logging.getLogger("hand2excal")
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    log.debug(
+        "numba not installed; node spacing falls back to pure Python. "
+        "Install with `pip install .[fast]` for large flowcharts."
+    )
+
+    def njit(*args, **kwargs):
+        """No-op stand-in for numba.njit."""
+        return lambda fn: fn
 
 
 def _generate_id() -> str:
     """Generate a unique Excalidraw element ID."""
-    return "".join(random.choices(string.ascii_letters + string.digits, k=20))
+    return base64.urlsafe_b64encode(os.urandom(15)).decode("ascii")
 
 
 def _seed() -> int:
     """Generate a random seed for Excalidraw rendering."""
-    return random.randint(1, 2**31 - 1)
+    return int.from_bytes(os.urandom(4), "little") & 0x7FFFFFFF or 1
 
 
 def _timestamp() -> int:
@@ -47,10 +68,25 @@ _COLOR_MAP = {
 }
 
 
+# Exact-match lookup for the spellings models actually emit: canonical
+# names, their capitalized forms, our own hex outputs and "transparent".
+# Anything else goes through the lower/strip path below.
+_COLOR_LUT = {
+    **_COLOR_MAP,
+    **{name.capitalize(): hex_code for name, hex_code in _COLOR_MAP.items()},
+    **{hex_code: hex_code for hex_code in _COLOR_MAP.values()},
+    "transparent": "transparent",
+}
+
+
+@lru_cache(maxsize=256)
 def _normalize_color(color: str) -> str:
     """Normalize a color string to a hex code."""
-    if not color or color == "transparent":
+    if not color:
         return "transparent"
+    hit = _COLOR_LUT.get(color)
+    if hit is not None:
+        return hit
     color = color.lower().strip()
     if color.startswith("#"):
         return color
@@ -59,6 +95,38 @@ def _normalize_color(color: str) -> str:
 
 # ---------- Element builders ----------
 
+# Static element properties. Per-element keys are listed too (as None) so
+# that filling them in keeps Excalidraw's usual key order.
+_BASE_TEMPLATE = {
+    "id": None,
+    "type": None,
+    "x": None,
+    "y": None,
+    "width": None,
+    "height": None,
+    "angle": 0,
+    "strokeColor": None,
+    "backgroundColor": None,
+    "fillStyle": "solid",
+    "strokeWidth": 2,
+    "strokeStyle": "solid",
+    "roughness": 1,
+    "opacity": 100,
+    "groupIds": None,
+    "frameId": None,
+    "index": None,
+    "roundness": None,
+    "seed": None,
+    "version": 1,
+    "versionNonce": None,
+    "isDeleted": False,
+    "boundElements": None,
+    "updated": None,
+    "link": None,
+    "locked": False,
+}
+
+
 def _base_element(
     element_type: str,
     x: float,
@@ -67,39 +135,31 @@ def _base_element(
     height: float,
     stroke_color: str = "#1e1e1e",
     bg_color: str = "transparent",
+    updated: int | None = None,
 ) -> dict:
-    """Create a base Excalidraw element with common properties."""
-    return {
-        "id": _generate_id(),
-        "type": element_type,
-        "x": x,
-        "y": y,
-        "width": width,
-        "height": height,
-        "angle": 0,
-        "strokeColor": _normalize_color(stroke_color),
-        "backgroundColor": _normalize_color(bg_color),
-        "fillStyle": "solid" if bg_color and bg_color != "transparent" else "solid",
-        "strokeWidth": 2,
-        "strokeStyle": "solid",
-        "roughness": 1,
-        "opacity": 100,
-        "groupIds": [],
-        "frameId": None,
-        "index": None,
-        "roundness": None,
-        "seed": _seed(),
-        "version": 1,
-        "versionNonce": _seed(),
-        "isDeleted": False,
-        "boundElements": [],
-        "updated": _timestamp(),
-        "link": None,
-        "locked": False,
-    }
+    """
+    Create a base Excalidraw element with common properties.
+    `updated` is the element timestamp in ms; defaults to now.
+    """
+    element = _BASE_TEMPLATE.copy()
+    element["id"] = _generate_id()
+    element["type"] = element_type
+    element["x"] = x
+    element["y"] = y
+    element["width"] = width
+    element["height"] = height
+    element["strokeColor"] = _normalize_color(stroke_color)
+    element["backgroundColor"] = _normalize_color(bg_color)
+    # Lists are per-element: never share the template's
+    element["groupIds"] = []
+    element["seed"] = _seed()
+    element["versionNonce"] = _seed()
+    element["boundElements"] = []
+    element["updated"] = updated if updated is not None else _timestamp()
+    return element
 
 
-def _create_shape(node: dict) -> dict:
+def _create_shape(node: dict, updated: int | None = None) -> dict:
     """Create a shape element from a node definition."""
     shape_type = node.get("type", "rectangle")
     element = _base_element(
@@ -110,6 +170,7 @@ def _create_shape(node: dict) -> dict:
         height=node.get("height", 60),
         stroke_color=node.get("strokeColor", "#1e1e1e"),
         bg_color=node.get("backgroundColor", "transparent"),
+        updated=updated,
     )
 
     # Roundness settings
@@ -135,6 +196,7 @@ def _create_text(
     stroke_color: str = "#1e1e1e",
     font_size: int = 16,
     container_id: str | None = None,
+    updated: int | None = None,
 ) -> dict:
     """Create a text element, optionally bound to a container."""
     element = _base_element(
@@ -144,6 +206,7 @@ def _create_text(
         width=width,
         height=height,
         stroke_color=stroke_color,
+        updated=updated,
     )
     element["text"] = text
     element["fontSize"] = font_size
@@ -154,51 +217,62 @@ def _create_text(
     element["originalText"] = text
     element["autoResize"] = True
     element["lineHeight"] = 1.25
-    # Text elements don't have roundness/fill
-    element["backgroundColor"] = "transparent"
-    element["fillStyle"] = "solid"
+    # Text elements have no fill: _base_element's default background is
+    # already "transparent" with the template's "solid" fillStyle.
 
     return element
 
 
-def _edge_point(element: dict, dx: float, dy: float) -> tuple[float, float]:
+@dataclass(slots=True)
+class ShapeGeom:
+    """Placed shape geometry used for arrow routing (never serialized)."""
+
+    type: str
+    w: float
+    h: float
+    cx: float
+    cy: float
+
+    @classmethod
+    def from_element(cls, element: dict) -> "ShapeGeom":
+        w = element["width"]
+        h = element["height"]
+        return cls(
+            type=element["type"],
+            w=w,
+            h=h,
+            cx=element["x"] + w * 0.5,
+            cy=element["y"] + h * 0.5,
+        )
+
+
+def _edge_point(geom: ShapeGeom, dx: float, dy: float) -> tuple[float, float]:
     """
     Calculate where a ray from the center of a shape exits its boundary.
     (dx, dy) is the direction vector pointing outward.
     Returns the (x, y) point on the shape edge.
     """
-    cx = element["x"] + element["width"] / 2
-    cy = element["y"] + element["height"] / 2
-    w = element["width"]
-    h = element["height"]
-    shape_type = element["type"]
+    cx = geom.cx
+    cy = geom.cy
+    a = geom.w * 0.5
+    b = geom.h * 0.5
+    shape_type = geom.type
 
     if abs(dx) < 1e-9 and abs(dy) < 1e-9:
         return cx, cy
 
     if shape_type == "ellipse":
         # Ellipse: parametric intersection
-        a = w / 2
-        b = h / 2
-        denom = math.sqrt((dx / a) ** 2 + (dy / b) ** 2)
+        denom = math.hypot(dx / a, dy / b)
         if denom < 1e-9:
             return cx, cy
         t = 1.0 / denom
         return cx + dx * t, cy + dy * t
 
     elif shape_type == "diamond":
-        # Diamond: intersection with 4 diagonal edges
-        a = w / 2
-        b = h / 2
-        # The diamond has vertices at (cx±a, cy) and (cx, cy±b)
-        # Compute intersection with t * (dx, dy) against each edge
-        t = float("inf")
-        if abs(dx) > 1e-9:
-            t = min(t, abs(a / dx) * (1.0 / (abs(dx) / a + abs(dy) / b)))
-        if abs(dy) > 1e-9:
-            t = min(t, abs(b / dy) * (1.0 / (abs(dx) / a + abs(dy) / b)))
-        # Simpler formula: for a diamond, t = 1 / (|dx|/a + |dy|/b)
-        denom = abs(dx) / a + abs(dy) / b
+        # Diamond with vertices at (cx±a, cy) and (cx, cy±b):
+        # the ray meets the edge at t = 1 / (|dx|/a + |dy|/b)
+        denom = math.fabs(dx) / a + math.fabs(dy) / b
         if denom < 1e-9:
             return cx, cy
         t = 1.0 / denom
@@ -206,19 +280,23 @@ def _edge_point(element: dict, dx: float, dy: float) -> tuple[float, float]:
 
     else:
         # Rectangle: ray-box intersection
-        t = float("inf")
-        if abs(dx) > 1e-9:
-            t = min(t, (w / 2) / abs(dx))
-        if abs(dy) > 1e-9:
-            t = min(t, (h / 2) / abs(dy))
+        adx = math.fabs(dx)
+        ady = math.fabs(dy)
+        t = min(
+            a / adx if adx > 1e-9 else math.inf,
+            b / ady if ady > 1e-9 else math.inf,
+        )
         return cx + dx * t, cy + dy * t
 
 
 def _create_arrow(
-    from_element: dict,
-    to_element: dict,
+    from_id: str,
+    to_id: str,
+    from_geom: ShapeGeom,
+    to_geom: ShapeGeom,
     label: str = "",
     stroke_color: str = "#1e1e1e",
+    updated: int | None = None,
 ) -> tuple[dict, dict | None]:
     """
     Create an arrow element connecting two shapes.
@@ -228,13 +306,8 @@ def _create_arrow(
     GAP = 8  # visual gap between arrow tip and shape edge
 
     # Direction vector from source center to target center
-    from_cx = from_element["x"] + from_element["width"] / 2
-    from_cy = from_element["y"] + from_element["height"] / 2
-    to_cx = to_element["x"] + to_element["width"] / 2
-    to_cy = to_element["y"] + to_element["height"] / 2
-
-    dx = to_cx - from_cx
-    dy = to_cy - from_cy
+    dx = to_geom.cx - from_geom.cx
+    dy = to_geom.cy - from_geom.cy
     length = math.sqrt(dx * dx + dy * dy)
     if length < 1e-9:
         dx, dy = 0, 1
@@ -245,8 +318,8 @@ def _create_arrow(
     ndy = dy / length
 
     # Find where the line exits each shape boundary
-    start_x, start_y = _edge_point(from_element, dx, dy)
-    end_x, end_y = _edge_point(to_element, -dx, -dy)
+    start_x, start_y = _edge_point(from_geom, dx, dy)
+    end_x, end_y = _edge_point(to_geom, -dx, -dy)
 
     # Add gap offset (push start outward, push end outward)
     start_x += ndx * GAP
@@ -267,6 +340,7 @@ def _create_arrow(
         width=abs(rel_end_x),
         height=abs(rel_end_y),
         stroke_color=stroke_color,
+        updated=updated,
     )
     arrow["points"] = [[0, 0], [rel_end_x, rel_end_y]]
     arrow["lastCommittedPoint"] = None
@@ -276,13 +350,13 @@ def _create_arrow(
 
     # Bindings
     arrow["startBinding"] = {
-        "elementId": from_element["id"],
+        "elementId": from_id,
         "focus": 0,
         "gap": GAP,
         "fixedPoint": None,
     }
     arrow["endBinding"] = {
-        "elementId": to_element["id"],
+        "elementId": to_id,
         "focus": 0,
         "gap": GAP,
         "fixedPoint": None,
@@ -303,82 +377,164 @@ def _create_arrow(
             stroke_color=stroke_color,
             font_size=14,
             container_id=arrow["id"],
+            updated=updated,
         )
         arrow["boundElements"] = [{"id": label_element["id"], "type": "text"}]
 
     return arrow, label_element
 
 
-def _enforce_spacing(flowchart_data: dict, min_gap: int = 100) -> dict:
+# Explicit signature: the kernel is compiled (or loaded from the on-disk
+# cache) at import, so server startup pays for it instead of the first request
+@njit(
+    "UniTuple(float64[::1], 2)(float64[::1], float64[::1], float64[::1], float64[::1], float64, int64)",
+    cache=True,
+    nogil=True,
+)
+def _relax(xs, ys, ws, hs, min_gap, iters):
     """
-    Post-process node positions:
-    1. Scale all positions by 2x to spread nodes out
-    2. Enforce minimum gap between all node pairs
+    Push overlapping boxes apart along their dominant axis, in place.
+    Boxes are given as parallel x/y/width/height arrays; runs up to
+    `iters` passes and stops early once a pass moves nothing.
+
+    Each pass is a sort-and-sweep: centers are sorted along the axis they
+    spread out on most, and each box is only tested against the boxes
+    that follow it within overlap reach on that axis. Sort keys are taken
+    at the start of the pass, so the reach is widened by how far pushes
+    have moved boxes along that axis since then.
     """
-    nodes = flowchart_data.get("nodes", [])
-    if len(nodes) < 2:
-        return flowchart_data
-
-    # --- Step 1: Scale positions by 2x from the centroid ---
-    cx = sum(n["x"] + n["width"] / 2 for n in nodes) / len(nodes)
-    cy = sum(n["y"] + n["height"] / 2 for n in nodes) / len(nodes)
-    scale = 2.0
-    for n in nodes:
-        ncx = n["x"] + n["width"] / 2
-        ncy = n["y"] + n["height"] / 2
-        new_cx = cx + (ncx - cx) * scale
-        new_cy = cy + (ncy - cy) * scale
-        n["x"] = new_cx - n["width"] / 2
-        n["y"] = new_cy - n["height"] / 2
-
-    # --- Step 2: Push overlapping nodes apart ---
-    for _ in range(15):
+    n = len(xs)
+    cxs = np.empty(n)
+    cys = np.empty(n)
+    shift = np.empty(n)  # per-box movement along the sweep axis this pass
+    # Farthest a partner's center can be on each axis and still overlap,
+    # beyond the box's own half-extent
+    reach_x = max(ws) * 0.5 + min_gap
+    reach_y = max(hs) * 0.5 + min_gap
+
+    for _ in range(iters):
         moved = False
-        for i in range(len(nodes)):
-            for j in range(i + 1, len(nodes)):
-                a = nodes[i]
-                b = nodes[j]
 
-                a_cx = a["x"] + a["width"] / 2
-                a_cy = a["y"] + a["height"] / 2
-                b_cx = b["x"] + b["width"] / 2
-                b_cy = b["y"] + b["height"] / 2
-
-                dx = b_cx - a_cx
-                dy = b_cy - a_cy
+        for i in range(n):
+            cxs[i] = xs[i] + ws[i] * 0.5
+            cys[i] = ys[i] + hs[i] * 0.5
+        sweep_x = cxs.max() - cxs.min() >= cys.max() - cys.min()
+        if sweep_x:
+            keys = cxs
+            sizes = ws
+            reach = reach_x
+        else:
+            keys = cys
+            sizes = hs
+            reach = reach_y
+        order = np.argsort(keys, kind="mergesort")
+        # Largest distance any box has moved along the sweep axis so far
+        # this pass. Current centers are at most 2 * drift closer together
+        # than their keys say.
+        shift[:] = 0.0
+        drift = 0.0
+
+        for p in range(n):
+            first = order[p]
+            limit = keys[first] + sizes[first] * 0.5 + reach
+            for q in range(p + 1, n):
+                second = order[q]
+                if keys[second] >= limit + 2.0 * drift:
+                    break  # sorted: nothing further along can overlap
+
+                # Keep the original pair orientation (a = lower index)
+                i = min(first, second)
+                j = max(first, second)
+
+                dx = (xs[j] + ws[j] * 0.5) - (xs[i] + ws[i] * 0.5)
+                dy = (ys[j] + hs[j] * 0.5) - (ys[i] + hs[i] * 0.5)
 
                 # Required minimum distance on each axis
-                min_dx = (a["width"] + b["width"]) / 2 + min_gap
-                min_dy = (a["height"] + b["height"]) / 2 + min_gap
+                min_dx = (ws[i] + ws[j]) * 0.5 + min_gap
+                min_dy = (hs[i] + hs[j]) * 0.5 + min_gap
 
                 # Check if overlapping in both axes
                 if abs(dx) < min_dx and abs(dy) < min_dy:
                     if abs(dx) < 1 and abs(dy) < 1:
-                        dy = 1
+                        dy = 1.0
 
                     # Push along the dominant axis
                     if abs(dy) >= abs(dx):
-                        needed = min_dy
-                        shortfall = needed - abs(dy)
+                        shortfall = min_dy - abs(dy)
                         if shortfall > 0:
-                            push = shortfall / 2 + 5
-                            sign = 1 if dy >= 0 else -1
-                            b["y"] += push * sign
-                            a["y"] -= push * sign
+                            push = shortfall * 0.5 + 5
+                            if dy < 0:
+                                push = -push
+                            ys[j] += push
+                            ys[i] -= push
                             moved = True
+                            if not sweep_x:
+                                shift[j] += push
+                                shift[i] -= push
+                                drift = max(drift, abs(shift[i]), abs(shift[j]))
                     else:
-                        needed = min_dx
-                        shortfall = needed - abs(dx)
+                        shortfall = min_dx - abs(dx)
                         if shortfall > 0:
-                            push = shortfall / 2 + 5
-                            sign = 1 if dx >= 0 else -1
-                            b["x"] += push * sign
-                            a["x"] -= push * sign
+                            push = shortfall * 0.5 + 5
+                            if dx < 0:
+                                push = -push
+                            xs[j] += push
+                            xs[i] -= push
                             moved = True
+                            if sweep_x:
+                                shift[j] += push
+                                shift[i] -= push
+                                drift = max(drift, abs(shift[i]), abs(shift[j]))
 
         if not moved:
             break
 
+    return xs, ys
+
+
+def _enforce_spacing(flowchart_data: dict, min_gap: int = 100) -> dict:
+    """
+    Post-process node positions:
+    1. Scale all positions by 2x to spread nodes out
+    2. Enforce minimum gap between all node pairs
+    """
+    nodes = flowchart_data.get("nodes", [])
+    if len(nodes) < 2:
+        return flowchart_data
+
+    count = len(nodes)
+    xs = np.fromiter((n["x"] for n in nodes), dtype=np.float64, count=count)
+    ys = np.fromiter((n["y"] for n in nodes), dtype=np.float64, count=count)
+    ws = np.fromiter((n["width"] for n in nodes), dtype=np.float64, count=count)
+    hs = np.fromiter((n["height"] for n in nodes), dtype=np.float64, count=count)
+    if not (np.isfinite(xs).all() and np.isfinite(ys).all()
+            and np.isfinite(ws).all() and np.isfinite(hs).all()):
+        # One NaN would spread to every node through the centroid below
+        raise ValueError("Node x, y, width and height must be finite numbers")
+
+    # --- Step 1: Scale positions by 2x from the centroid ---
+    # Centers are computed once and reused for both the centroid and the scale.
+    cxs = xs + ws * 0.5
+    cys = ys + hs * 0.5
+    cx = cxs.mean()
+    cy = cys.mean()
+    scale = 2.0
+    xs = cx + (cxs - cx) * scale - ws * 0.5
+    ys = cy + (cys - cy) * scale - hs * 0.5
+
+    # --- Step 2: Push overlapping nodes apart ---
+    if HAS_NUMBA:
+        xs, ys = _relax(xs, ys, ws, hs, float(min_gap), 15)
+    else:
+        # Plain lists index much faster than ndarrays from the interpreter
+        xs, ys = _relax(xs.tolist(), ys.tolist(), ws.tolist(), hs.tolist(), float(min_gap), 15)
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+
+    for n, x, y in zip(nodes, xs.tolist(), ys.tolist()):
+        n["x"] = x
+        n["y"] = y
+
     flowchart_data["nodes"] = nodes
     return flowchart_data
 
@@ -396,13 +552,22 @@ def build_excalidraw(flowchart_data: dict) -> dict:
     # Enforce minimum spacing between nodes
     flowchart_data = _enforce_spacing(flowchart_data)
 
-    elements = []
-    node_id_to_element = {}  # maps our node id → excalidraw element
+    # One timestamp for the whole file
+    now = _timestamp()
+
+    nodes = flowchart_data.get("nodes", [])
+    arrows = flowchart_data.get("arrows", [])
+
+    # Every node and arrow yields at most two elements (itself + a label);
+    # fill a pre-sized list and trim the unused tail at the end.
+    elements = [None] * (2 * len(nodes) + 2 * len(arrows))
+    count = 0
+    node_id_to_element = {}  # maps our node id → (excalidraw element, geometry)
 
     # --- 1. Create shape elements for each node ---
-    for node in flowchart_data.get("nodes", []):
-        shape = _create_shape(node)
-        node_id_to_element[node["id"]] = shape
+    for node in nodes:
+        shape = _create_shape(node, updated=now)
+        node_id_to_element[node["id"]] = (shape, ShapeGeom.from_element(shape))
 
         # Create bound text label
         label_text = node.get("label", "").strip()
@@ -423,37 +588,51 @@ def build_excalidraw(flowchart_data: dict) -> dict:
                 stroke_color=shape["strokeColor"],
                 font_size=font_size,
                 container_id=shape["id"],
+                updated=now,
             )
 
             # Bind text to shape
             shape["boundElements"].append({"id": text_el["id"], "type": "text"})
-            elements.append(shape)
-            elements.append(text_el)
+            elements[count] = shape
+            elements[count + 1] = text_el
+            count += 2
         else:
-            elements.append(shape)
+            elements[count] = shape
+            count += 1
 
     # --- 2. Create arrow elements ---
-    for arrow_def in flowchart_data.get("arrows", []):
-        from_el = node_id_to_element.get(arrow_def.get("from_id"))
-        to_el = node_id_to_element.get(arrow_def.get("to_id"))
+    for arrow_def in arrows:
+        from_entry = node_id_to_element.get(arrow_def.get("from_id"))
+        to_entry = node_id_to_element.get(arrow_def.get("to_id"))
 
-        if not from_el or not to_el:
+        if not from_entry or not to_entry:
             continue  # skip arrows with invalid references
 
+        from_el, from_geom = from_entry
+        to_el, to_geom = to_entry
         arrow_el, label_el = _create_arrow(
-            from_element=from_el,
-            to_element=to_el,
+            from_id=from_el["id"],
+            to_id=to_el["id"],
+            from_geom=from_geom,
+            to_geom=to_geom,
             label=arrow_def.get("label", ""),
             stroke_color=arrow_def.get("strokeColor", "#1e1e1e"),
+            updated=now,
         )
 
-        # Register arrow as bound element on the connected shapes
-        from_el["boundElements"].append({"id": arrow_el["id"], "type": "arrow"})
-        to_el["boundElements"].append({"id": arrow_el["id"], "type": "arrow"})
+        # Register arrow as bound element on the connected shapes. Both ends
+        # share one (never mutated) binding dict; it serializes by value.
+        arrow_binding = {"id": arrow_el["id"], "type": "arrow"}
+        from_el["boundElements"].append(arrow_binding)
+        to_el["boundElements"].append(arrow_binding)
 
-        elements.append(arrow_el)
+        elements[count] = arrow_el
+        count += 1
         if label_el:
-            elements.append(label_el)
+            elements[count] = label_el
+            count += 1
+
+    del elements[count:]
 
     # --- 3. Assemble the .excalidraw structure ---
     return {
@@ -473,4 +652,4 @@ def build_excalidraw(flowchart_data: dict) -> dict:
 
 def build_excalidraw_json(flowchart_data: dict) -> str:
     """Build Excalidraw JSON and return as formatted string."""
-    return json.dumps(build_excalidraw(flowchart_data), indent=2)
+    return orjson.dumps(build_excalidraw(flowchart_data), option=orjson.OPT_INDENT_2).decode("utf-8")
@@ -2,11 +2,12 @@
 FastAPI server: Serves the frontend and provides the /api/convert endpoint.
 """
 
-import json
 import logging
 from pathlib import Path
 
+import orjson
 from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -14,75 +15,101 @@ from fastapi.staticfiles import StaticFiles
 from .vision import extract_flowchart_from_bytes, extract_flowchart_from_text
 from .excalidraw_builder import build_excalidraw
 
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (FastAPI's own class is deprecated)."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
 app = FastAPI(
     title="Hand2Excal",
     description="Convert handwritten flowcharts to Excalidraw files",
     version="0.1.0",
+    default_response_class=ORJSONResponse,
 )
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(message)s", datefmt="%H:%M:%S")
 log = logging.getLogger("hand2excal")
 
-# CORS for Vite dev server
+ALLOWED_CONTENT_TYPES = frozenset({
+    "image/jpeg", "image/png", "image/webp",
+    "image/gif", "image/bmp", "image/heic",
+})
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024  # 20MB limit
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# CORS for Vite dev server and HF Spaces. Starlette matches allow_origins
+# literally (no "*.hf.space" wildcards), so origins go through one regex.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "https://*.hf.space"],
+    allow_origin_regex=r"^(http://(localhost|127\.0\.0\.1):5173|https://[^/]+\.hf\.space)$",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 
+def _conversion_response(excalidraw_json: dict, nodes: list, arrows: list) -> ORJSONResponse:
+    """
+    Wrap a built Excalidraw document in the API's success envelope.
+    The document goes straight into orjson, so it is encoded exactly once.
+    """
+    return ORJSONResponse(content={
+        "success": True,
+        "excalidraw": excalidraw_json,
+        "metadata": {
+            "nodes_count": len(nodes),
+            "arrows_count": len(arrows),
+        },
+    })
+
+
 @app.post("/api/convert")
 async def convert_image(file: UploadFile = File(...)):
     """
     Upload a handwritten flowchart image, returns Excalidraw JSON.
     """
     # Validate file type
-    allowed_types = {
-        "image/jpeg", "image/png", "image/webp",
-        "image/gif", "image/bmp", "image/heic",
-    }
     content_type = file.content_type or "image/jpeg"
-    if content_type not in allowed_types:
+    if content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(
             status_code=400,
             detail=f"Unsupported file type: {content_type}. Use JPG, PNG, or WebP.",
         )
 
-    # Read image bytes
-    image_bytes = await file.read()
+    # Read image bytes in chunks, bailing out as soon as the limit is crossed
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=400, detail="Image too large. Max 20MB.")
+    image_bytes = bytes(buf)
     size_mb = len(image_bytes) / (1024 * 1024)
-    if len(image_bytes) > 20 * 1024 * 1024:  # 20MB limit
-        raise HTTPException(status_code=400, detail="Image too large. Max 20MB.")
 
     log.info(f"📸 Received: {file.filename} ({size_mb:.1f} MB, {content_type})")
 
     try:
         # Step 1: Extract flowchart data using Qwen
         log.info("🤖 Sending to Qwen for analysis...")
-        flowchart_data = extract_flowchart_from_bytes(image_bytes, content_type)
+        flowchart_data = await run_in_threadpool(extract_flowchart_from_bytes, image_bytes, content_type)
         nodes = flowchart_data.get("nodes", [])
         arrows = flowchart_data.get("arrows", [])
         log.info(f"📐 Extracted: {len(nodes)} shapes, {len(arrows)} connections")
-        for n in nodes:
-            log.info(f"   🔷 {n.get('id')}: {n.get('type')} \"{n.get('label')}\" at ({n.get('x')},{n.get('y')})")
-        for a in arrows:
-            log.info(f"   ➡️  {a.get('from_id')} → {a.get('to_id')} \"{a.get('label', '')}\"")
+        if log.isEnabledFor(logging.INFO) and (nodes or arrows):
+            # One record for the whole breakdown instead of one per shape/arrow
+            log.info("\n".join([
+                *(f"   🔷 {n.get('id')}: {n.get('type')} \"{n.get('label')}\" at ({n.get('x')},{n.get('y')})" for n in nodes),
+                *(f"   ➡️  {a.get('from_id')} → {a.get('to_id')} \"{a.get('label', '')}\"" for a in arrows),
+            ]))
 
         # Step 2: Build Excalidraw JSON
         log.info("🔧 Building Excalidraw file...")
-        excalidraw_json = build_excalidraw(flowchart_data)
+        excalidraw_json = await run_in_threadpool(build_excalidraw, flowchart_data)
         log.info("✅ Conversion complete!")
 
-        return JSONResponse(content={
-            "success": True,
-            "excalidraw": excalidraw_json,
-            "metadata": {
-                "nodes_count": len(nodes),
-                "arrows_count": len(arrows),
-            },
-        })
+        return _conversion_response(excalidraw_json, nodes, arrows)
 
     except ValueError as e:
         log.error(f"❌ Validation error: {e}")
@@ -110,24 +137,17 @@ async def convert_text(request: TextConvertRequest):
     try:
         # Step 1: Extract flowchart data using Llama
         log.info("🤖 Sending to LLM for text analysis...")
-        flowchart_data = extract_flowchart_from_text(request.text)
+        flowchart_data = await run_in_threadpool(extract_flowchart_from_text, request.text)
         nodes = flowchart_data.get("nodes", [])
         arrows = flowchart_data.get("arrows", [])
         log.info(f"📐 Extracted: {len(nodes)} shapes, {len(arrows)} connections")
         
         # Step 2: Build Excalidraw JSON
         log.info("🔧 Building Excalidraw file...")
-        excalidraw_json = build_excalidraw(flowchart_data)
+        excalidraw_json = await run_in_threadpool(build_excalidraw, flowchart_data)
         log.info("✅ Text Conversion complete!")
 
-        return JSONResponse(content={
-            "success": True,
-            "excalidraw": excalidraw_json,
-            "metadata": {
-                "nodes_count": len(nodes),
-                "arrows_count": len(arrows),
-            },
-        })
+        return _conversion_response(excalidraw_json, nodes, arrows)
 
     except ValueError as e:
         log.error(f"❌ Validation error: {e}")
@@ -3,29 +3,45 @@ Vision module: Uses Qwen2.5-VL via HuggingFace Inference API
 to extract structured flowchart data from handwritten images.
 """
 
-import base64
+import asyncio
+import copy
+import hashlib
 import io
-import json
+import math
 import os
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
-from PIL import Image
 try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
+    import pybase64 as base64  # SIMD-accelerated, drop-in for the stdlib API
+    _b64encode_str = base64.b64encode_as_string
 except ImportError:
-    pass  # HEIC support optional
+    import base64
+
+    def _b64encode_str(data: bytes) -> str:
+        return base64.b64encode(data).decode("ascii")
+
+import orjson
+from PIL import Image, UnidentifiedImageError
 
 from dotenv import load_dotenv
-from huggingface_hub import InferenceClient
+from huggingface_hub import AsyncInferenceClient, InferenceClient
 
 load_dotenv()
+_HF_TOKEN = os.getenv("HF_API_TOKEN")
 
 QWEN_MODEL = "Qwen/Qwen2.5-VL-7B-Instruct"
 # QWEN_MODEL = "Qwen/Qwen3-VL-235B-A22B-Instruct"
 TEXT_MODEL = "meta-llama/Meta-Llama-3-8B-Instruct"
 
+# Default cap on generated tokens. A pretty-printed 20-node chart with its
+# arrows is ~3k tokens, so lower caps risk truncating large flowcharts.
+MAX_TOKENS = 4096
+
 SYSTEM_PROMPT = """You are an expert at analyzing handwritten flowcharts and diagrams. 
 Given an image of a handwritten flowchart, you must extract ALL shapes, text, and connections into a precise structured JSON format.
 
@@ -133,46 +149,222 @@ Important:
 - Return ONLY the JSON object, nothing else"""
 
 
+# Let the inference API answer repeated identical requests from its
+# response cache instead of re-running the model.
+_CLIENT_HEADERS = {"x-use-cache": "true"}
+
+# Shared client so HTTP keep-alive and TLS sessions are reused across calls
+_CLIENT: InferenceClient | None = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def _require_token() -> str:
+    """Return the HF API token (read once at import), or raise if it is not configured."""
+    if not _HF_TOKEN:
+        raise ValueError("HF_API_TOKEN not set. Copy .env.example to .env and add your token.")
+    return _HF_TOKEN
+
+
+def _get_client() -> InferenceClient:
+    """Return the process-wide InferenceClient, creating it on first use."""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = InferenceClient(token=_require_token(), headers=_CLIENT_HEADERS)
+    return _CLIENT
+
+
+def _reset_client() -> None:
+    """Drop the shared client in a forked child so it opens its own connections."""
+    global _CLIENT, _CLIENT_LOCK
+    _CLIENT = None
+    _CLIENT_LOCK = threading.Lock()  # the parent's lock may have been held mid-fork
+
+
+def _image_messages(data_url: str) -> list[dict]:
+    """Chat messages asking the vision model to analyze one image."""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": data_url}},
+                {
+                    "type": "text",
+                    "text": "Analyze this handwritten flowchart and extract all shapes, text, and connections into the JSON format specified.",
+                },
+            ],
+        },
+    ]
+
+
+# Recent image extractions keyed by a hash of the normalized JPEG, so a
+# re-uploaded image skips the VLM round-trip. Set DISABLE_VLM_CACHE=1 to
+# turn it off. Entries are deep-copied in and out because callers mutate
+# the result (spacing rewrites node positions).
+_VLM_CACHE: OrderedDict[bytes, dict] = OrderedDict()
+_VLM_CACHE_SIZE = 128
+_VLM_CACHE_LOCK = threading.Lock()
+
+
+def _vlm_cache_get(key: bytes) -> dict | None:
+    """Return a copy of the cached extraction for `key`, if any."""
+    with _VLM_CACHE_LOCK:
+        data = _VLM_CACHE.get(key)
+        if data is None:
+            return None
+        _VLM_CACHE.move_to_end(key)
+    return copy.deepcopy(data)
+
+
+def _vlm_cache_put(key: bytes, data: dict) -> None:
+    """Store a copy of an extraction, evicting the least recently used."""
+    data = copy.deepcopy(data)
+    with _VLM_CACHE_LOCK:
+        _VLM_CACHE[key] = data
+        _VLM_CACHE.move_to_end(key)
+        if len(_VLM_CACHE) > _VLM_CACHE_SIZE:
+            _VLM_CACHE.popitem(last=False)
+
+
+def _reset_vlm_cache() -> None:
+    """Start a forked child with an empty cache and a fresh lock."""
+    global _VLM_CACHE, _VLM_CACHE_LOCK
+    # Another thread may have held the lock, mid-update, when we forked
+    _VLM_CACHE = OrderedDict()
+    _VLM_CACHE_LOCK = threading.Lock()
+
+
+# Forked workers (e.g. a gunicorn master with preload) must not share the
+# parent's pooled sockets, and must not inherit a lock held at fork time.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client)
+    os.register_at_fork(after_in_child=_reset_vlm_cache)
+
+
 def _image_to_data_url(image_path: str) -> str:
     """Convert a local image to a base64 data URL, converting unsupported formats."""
-    path = Path(image_path)
-    suffix = path.suffix.lower()
-    mime_map = {
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".webp": "image/webp",
-        ".gif": "image/gif",
-        ".bmp": "image/bmp",
-        ".heic": "image/heic",
-    }
-    content_type = mime_map.get(suffix, "image/jpeg")
-    image_bytes = path.read_bytes()
-    image_bytes, content_type = _ensure_jpeg(image_bytes, content_type)
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    return f"data:{content_type};base64,{b64}"
+    # Hand Pillow the path: the raw file is decoded straight from disk
+    # instead of first being read into memory in full. The format is
+    # detected from the file's content, not its suffix.
+    image_bytes, content_type = _ensure_jpeg(Path(image_path))
+    return _image_bytes_to_data_url(image_bytes, content_type)
 
 
-def _ensure_jpeg(image_bytes: bytes, content_type: str) -> tuple[bytes, str]:
-    """Resize and convert images to JPEG for the API (keeps payload small)."""
-    img = Image.open(io.BytesIO(image_bytes))
-    img = img.convert("RGB")
+@lru_cache(maxsize=None)
+def _ensure_heif_opener() -> bool:
+    """
+    Register the HEIC opener with Pillow on first use. pillow_heif loads
+    native libheif, so it is only imported once a HEIC image shows up.
+    """
+    try:
+        import pillow_heif
+    except ImportError:
+        return False  # HEIC support optional
+    pillow_heif.register_heif_opener()
+    return True
 
-    # Resize if larger than 1200px on any side
+
+def _open_image(image: bytes | Path) -> Image.Image:
+    """
+    Open raw image bytes or a path with Pillow (lazily: header only). If
+    Pillow can't identify it, register the HEIC opener and retry once, so
+    HEIC files are recognized by content whatever their name or type.
+    """
+    try:
+        return Image.open(image if isinstance(image, Path) else io.BytesIO(image))
+    except UnidentifiedImageError:
+        if not _ensure_heif_opener():
+            raise
+    return Image.open(image if isinstance(image, Path) else io.BytesIO(image))
+
+
+def _ensure_jpeg(image: bytes | Path) -> tuple[bytes, str]:
+    """
+    Resize and convert images to JPEG for the API (keeps payload small).
+    `image` is either the raw file bytes or a path to the file; Pillow
+    detects the format from its content.
+    """
     max_dim = 1200
+    with _open_image(image) as img:
+        if (
+            img.format == "JPEG"
+            and max(img.size) <= max_dim
+            and img.mode in ("RGB", "L")
+            and all(marker == "APP0" for marker, _ in img.applist)
+        ):
+            # Already a small, plain JPEG: send it as-is instead of re-encoding.
+            # Only when it carries no metadata beyond the JFIF header; EXIF,
+            # XMP, comments etc. (GPS, device info) are stripped by re-encoding.
+            return (image.read_bytes() if isinstance(image, Path) else image), "image/jpeg"
+        if img.format == "JPEG":
+            # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding; draft()
+            # never goes below max_dim, thumbnail() below does the exact fit.
+            img.draft("RGB", (max_dim, max_dim))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        else:
+            img.load()  # decode now, while the file is still open
+
+    # Resize if larger than 1200px on any side
     if max(img.size) > max_dim:
         img.thumbnail((max_dim, max_dim), Image.LANCZOS)
 
+    # Baseline 4:2:0 JPEG without the extra Huffman-optimization pass: the
+    # payload is only ever read by the model, so encode speed wins. An empty
+    # comment keeps Pillow from copying the source's COM segment across.
     buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=85)
+    img.save(
+        buf, format="JPEG", quality=85, optimize=False, progressive=False, subsampling=2, comment=b""
+    )
     return buf.getvalue(), "image/jpeg"
 
 
 def _image_bytes_to_data_url(image_bytes: bytes, content_type: str = "image/jpeg") -> str:
-    """Convert image bytes to a base64 data URL, converting unsupported formats first."""
-    image_bytes, content_type = _ensure_jpeg(image_bytes, content_type)
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    return f"data:{content_type};base64,{b64}"
+    """Convert already-normalized image bytes (see _ensure_jpeg) to a base64 data URL."""
+    # pybase64 writes the base64 text straight into a str, skipping the
+    # intermediate bytes object and its decode copy
+    return f"data:{content_type};base64,{_b64encode_str(image_bytes)}"
+
+
+# Markdown code fence around the JSON, and the characters that matter
+# when scanning for a balanced {...} object
+_FENCE_RE = re.compile(r"```(?:json)?\s*\n?(.*?)\n?\s*```", re.DOTALL)
+_STRUCTURAL_RE = re.compile(r'[{}"\\]')
+
+
+def _find_first_json_object(s: str) -> str | None:
+    """
+    Return the first balanced {...} span in `s`, or None. Braces inside
+    string literals (including escaped quotes) are ignored, so trailing
+    prose after the object is never swallowed.
+    """
+    start = s.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    skip = -1  # index of a character escaped by a backslash
+    for m in _STRUCTURAL_RE.finditer(s, start):
+        i = m.start()
+        if i == skip:
+            continue
+        ch = s[i]
+        if in_string:
+            if ch == "\\":
+                skip = i + 1
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
 
 
 def _extract_json(text: str) -> dict:
@@ -180,29 +372,70 @@ def _extract_json(text: str) -> dict:
     # Try direct parse first
     text = text.strip()
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         pass
 
     # Try extracting from markdown code fence
-    match = re.search(r"```(?:json)?\s*\n?(.*?)\n?\s*```", text, re.DOTALL)
+    match = _FENCE_RE.search(text)
     if match:
         try:
-            return json.loads(match.group(1).strip())
-        except json.JSONDecodeError:
+            return orjson.loads(match.group(1).strip())
+        except orjson.JSONDecodeError:
             pass
 
     # Try finding first { ... } block
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if match:
+    obj = _find_first_json_object(text)
+    if obj is not None:
         try:
-            return json.loads(match.group(0))
-        except json.JSONDecodeError:
+            return orjson.loads(obj)
+        except orjson.JSONDecodeError:
             pass
 
     raise ValueError(f"Could not extract valid JSON from model response:\n{text[:500]}")
 
 
+# Fallback fields for whatever the model left out. Node x/y depend on the
+# node's index (a 4-wide grid) so they are filled in per node.
+_NODE_DEFAULTS = {
+    "type": "rectangle",
+    "label": "",
+    "width": 150,
+    "height": 60,
+    "strokeColor": "#1e1e1e",
+    "backgroundColor": "transparent",
+    "rounded": False,
+}
+_ARROW_DEFAULTS = {
+    "label": "",
+    "strokeColor": "#1e1e1e",
+}
+
+
+def _grid_position(i: int) -> tuple[int, int]:
+    """Fallback (x, y) for the i-th node."""
+    return 100 + (i % 4) * 200, 100 + (i // 4) * 150
+
+
+def _as_number(value, default):
+    """
+    Return `value` if it is a finite number, its float value if it is a
+    numeric string (e.g. "300"), and `default` for anything else
+    (null, booleans, non-numeric strings, NaN/inf).
+    """
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return value if math.isfinite(value) else default
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return default
+        return number if math.isfinite(number) else default
+    return default
+
+
 def _validate_flowchart_data(data: dict) -> dict:
     """Validate and normalize the extracted flowchart data."""
     if "nodes" not in data:
@@ -210,67 +443,47 @@ def _validate_flowchart_data(data: dict) -> dict:
     if "arrows" not in data:
         data["arrows"] = []
 
-    node_ids = set()
+    # Defaults first, then whatever the model provided on top
+    nodes = []
     for i, node in enumerate(data["nodes"]):
-        if "id" not in node:
-            node["id"] = f"node_{i + 1}"
-        node_ids.add(node["id"])
-
-        # Defaults
-        node.setdefault("type", "rectangle")
-        node.setdefault("label", "")
-        node.setdefault("x", 100 + (i % 4) * 200)
-        node.setdefault("y", 100 + (i // 4) * 150)
-        node.setdefault("width", 150)
-        node.setdefault("height", 60)
-        node.setdefault("strokeColor", "#1e1e1e")
-        node.setdefault("backgroundColor", "transparent")
-        node.setdefault("rounded", False)
+        x, y = _grid_position(i)
+        node = {"id": f"node_{i + 1}", **_NODE_DEFAULTS, "x": x, "y": y, **node}
+
+        # Geometry must be numeric: an explicit null (or junk) from the
+        # model falls back to the default rather than reaching the layout
+        node["x"] = _as_number(node["x"], x)
+        node["y"] = _as_number(node["y"], y)
+        node["width"] = _as_number(node["width"], _NODE_DEFAULTS["width"])
+        node["height"] = _as_number(node["height"], _NODE_DEFAULTS["height"])
 
         # Clamp type
         if node["type"] not in ("rectangle", "ellipse", "diamond"):
             node["type"] = "rectangle"
+        nodes.append(node)
+    data["nodes"] = nodes
 
     # Validate arrows
-    valid_arrows = []
-    for arrow in data["arrows"]:
-        if arrow.get("from_id") in node_ids and arrow.get("to_id") in node_ids:
-            arrow.setdefault("label", "")
-            arrow.setdefault("strokeColor", "#1e1e1e")
-            valid_arrows.append(arrow)
-
-    data["arrows"] = valid_arrows
+    node_ids = {node["id"] for node in nodes}
+    data["arrows"] = [
+        {**_ARROW_DEFAULTS, **arrow}
+        for arrow in data["arrows"]
+        if arrow.get("from_id") in node_ids and arrow.get("to_id") in node_ids
+    ]
     return data
 
 
-def extract_flowchart_from_image(image_path: str) -> dict:
+def extract_flowchart_from_image(image_path: str, max_tokens: int = MAX_TOKENS) -> dict:
     """
     Extract flowchart structure from a handwritten image file.
     Returns validated dict with 'nodes' and 'arrows'.
     """
-    token = os.getenv("HF_API_TOKEN")
-    if not token:
-        raise ValueError("HF_API_TOKEN not set. Copy .env.example to .env and add your token.")
-
-    client = InferenceClient(token=token)
+    client = _get_client()
     data_url = _image_to_data_url(image_path)
 
     response = client.chat_completion(
         model=QWEN_MODEL,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": data_url}},
-                    {
-                        "type": "text",
-                        "text": "Analyze this handwritten flowchart and extract all shapes, text, and connections into the JSON format specified.",
-                    },
-                ],
-            },
-        ],
-        max_tokens=4096,
+        messages=_image_messages(data_url),
+        max_tokens=max_tokens,
         temperature=0.1,
     )
 
@@ -279,52 +492,120 @@ def extract_flowchart_from_image(image_path: str) -> dict:
     return _validate_flowchart_data(flowchart_data)
 
 
-def extract_flowchart_from_bytes(image_bytes: bytes, content_type: str = "image/jpeg") -> dict:
+async def extract_flowchart_from_image_async(image_path: str, max_tokens: int = MAX_TOKENS) -> dict:
+    """
+    Async variant of extract_flowchart_from_image for event-loop callers.
+    Reading and normalizing the image runs in a worker thread and the model
+    call goes through AsyncInferenceClient, so calls can overlap.
+    Returns validated dict with 'nodes' and 'arrows'.
+    """
+    token = _require_token()
+    async with AsyncInferenceClient(token=token, headers=_CLIENT_HEADERS) as client:
+        return await _extract_image_async(client, image_path, max_tokens)
+
+
+async def extract_flowchart_from_images_batch_async(
+    image_paths: list[str],
+    concurrency: int = 8,
+    max_tokens: int = MAX_TOKENS,
+) -> list[dict]:
+    """
+    Extract flowcharts from several image files concurrently.
+    At most `concurrency` model calls are in flight at once, sharing one
+    client. Results are in the same order as `image_paths`.
+    """
+    token = _require_token()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with AsyncInferenceClient(token=token, headers=_CLIENT_HEADERS) as client:
+        async def extract_one(image_path: str) -> dict:
+            async with semaphore:
+                return await _extract_image_async(client, image_path, max_tokens)
+
+        tasks = [asyncio.ensure_future(extract_one(p)) for p in image_paths]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            # gather() raises as soon as one image fails; stop the others
+            # before the client is closed underneath them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+def extract_flowchart_from_images_batch(
+    image_paths: list[str],
+    max_workers: int = 8,
+    max_tokens: int = MAX_TOKENS,
+) -> list[dict]:
+    """
+    Blocking counterpart of extract_flowchart_from_images_batch_async.
+    The work is network-bound, so a thread pool over the sync entrypoint
+    overlaps the model calls. Results are in the same order as `image_paths`.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda p: extract_flowchart_from_image(p, max_tokens), image_paths))
+
+
+async def _extract_image_async(client: AsyncInferenceClient, image_path: str, max_tokens: int) -> dict:
+    """Run one image through the vision model on an open async client."""
+    data_url = await asyncio.to_thread(_image_to_data_url, image_path)
+    response = await client.chat_completion(
+        model=QWEN_MODEL,
+        messages=_image_messages(data_url),
+        max_tokens=max_tokens,
+        temperature=0.1,
+    )
+
+    raw_text = response.choices[0].message.content
+    flowchart_data = _extract_json(raw_text)
+    return _validate_flowchart_data(flowchart_data)
+
+
+def extract_flowchart_from_bytes(
+    image_bytes: bytes,
+    content_type: str = "image/jpeg",
+    max_tokens: int = MAX_TOKENS,
+) -> dict:
     """
     Extract flowchart structure from image bytes (used by the API endpoint).
+    `content_type` is the uploader's claim and is not relied on: the
+    format is detected from the bytes themselves.
     Returns validated dict with 'nodes' and 'arrows'.
     """
-    token = os.getenv("HF_API_TOKEN")
-    if not token:
-        raise ValueError("HF_API_TOKEN not set. Copy .env.example to .env and add your token.")
+    image_bytes, content_type = _ensure_jpeg(image_bytes)
 
-    client = InferenceClient(token=token)
+    cache_key = None
+    if not os.getenv("DISABLE_VLM_CACHE"):
+        cache_key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+        cached = _vlm_cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+    client = _get_client()
     data_url = _image_bytes_to_data_url(image_bytes, content_type)
 
     response = client.chat_completion(
         model=QWEN_MODEL,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": data_url}},
-                    {
-                        "type": "text",
-                        "text": "Analyze this handwritten flowchart and extract all shapes, text, and connections into the JSON format specified.",
-                    },
-                ],
-            },
-        ],
-        max_tokens=4096,
+        messages=_image_messages(data_url),
+        max_tokens=max_tokens,
         temperature=0.1,
     )
 
     raw_text = response.choices[0].message.content
-    flowchart_data = _extract_json(raw_text)
-    return _validate_flowchart_data(flowchart_data)
+    flowchart_data = _validate_flowchart_data(_extract_json(raw_text))
+    if cache_key is not None:
+        _vlm_cache_put(cache_key, flowchart_data)
+    return flowchart_data
 
 
-def extract_flowchart_from_text(text: str) -> dict:
+def extract_flowchart_from_text(text: str, max_tokens: int = MAX_TOKENS) -> dict:
     """
     Extract flowchart structure from text description.
     Returns validated dict with 'nodes' and 'arrows'.
     """
-    token = os.getenv("HF_API_TOKEN")
-    if not token:
-        raise ValueError("HF_API_TOKEN not set. Copy .env.example to .env and add your token.")
-
-    client = InferenceClient(token=token)
+    client = _get_client()
 
     response = client.chat_completion(
         model=TEXT_MODEL,
@@ -335,7 +616,7 @@ def extract_flowchart_from_text(text: str) -> dict:
                 "content": text,
             },
         ],
-        max_tokens=4096,
+        max_tokens=max_tokens,
         temperature=0.1,
     )
 
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from app import vision
+
+
+class _StubResponse:
+    def __init__(self, content: str):
+        message = type("Message", (), {"content": content})
+        choice = type("Choice", (), {"message": message})
+        self.choices = [choice]
+
+
+class _StubAsyncClient:
+    """Stands in for AsyncInferenceClient; records calls that outlive it."""
+
+    instances: list["_StubAsyncClient"] = []
+
+    def __init__(self, **kwargs):
+        self.closed = False
+        self.finished_after_close = []
+        self.cancelled = []
+        _StubAsyncClient.instances.append(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.closed = True
+
+    async def chat_completion(self, messages, **kwargs):
+        data_url = messages[1]["content"][0]["image_url"]["url"]
+        if data_url == "bad.png":
+            raise RuntimeError("model call failed")
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self.cancelled.append((data_url, self.closed))
+            raise
+        if self.closed:
+            self.finished_after_close.append(data_url)
+        return _StubResponse('{"nodes": [], "arrows": []}')
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    _StubAsyncClient.instances.clear()
+    monkeypatch.setattr(vision, "AsyncInferenceClient", _StubAsyncClient)
+    monkeypatch.setattr(vision, "_HF_TOKEN", "test-token")
+    monkeypatch.setattr(vision, "_image_to_data_url", lambda path: path)
+    return _StubAsyncClient
+
+
+def test_batch_async_returns_results_in_order(stub_client):
+    results = asyncio.run(vision.extract_flowchart_from_images_batch_async(["a.png", "b.png"]))
+    assert results == [{"nodes": [], "arrows": []}] * 2
+
+
+def test_batch_async_failure_cancels_in_flight_requests(stub_client):
+    paths = ["a.png", "bad.png", "c.png", "d.png"]
+
+    async def run_and_keep_loop_alive():
+        with pytest.raises(RuntimeError, match="model call failed"):
+            await vision.extract_flowchart_from_images_batch_async(paths)
+        # Give any leftover extraction time to finish on the closed client
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run_and_keep_loop_alive())
+
+    client = stub_client.instances[0]
+    assert client.closed
+    assert client.finished_after_close == []
+    # Cancelled while the client was still open
+    assert sorted(client.cancelled) == [("a.png", False), ("c.png", False), ("d.png", False)]